@@ -10,6 +10,16 @@ class Config:
     DB_USER = os.getenv('DB_USER', 'postgres')
     DB_PASSWORD = os.getenv('DB_PASSWORD', '')
     
+    # Connection pool tuning
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '20'))
+    DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '40'))
+    DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+    DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', '30'))
+    
+    # Per-request SQL warning thresholds
+    SQL_WARN_QUERY_COUNT = int(os.getenv('SQL_WARN_QUERY_COUNT', '5'))
+    SQL_WARN_TIME_MS = float(os.getenv('SQL_WARN_TIME_MS', '50'))
+    
     @staticmethod
     def get_db_config():
         return {
@@ -1,11 +1,39 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import and_, func
+from sqlalchemy.orm import Session, joinedload, raiseload
+from sqlalchemy import and_, bindparam, func, insert, lambda_stmt, literal, select, true, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from models import *
 from schemas import *
-from datetime import datetime
-from typing import Tuple, Dict, Any
-import random
-import string
+from datetime import datetime, date, timezone
+from typing import Tuple, Dict, Any, List, Optional
+import secrets
+import threading
+import time
+
+# Hot-path statements, built once per process. lambda_stmt caches their
+# construction and compiled SQL; values are passed as bound parameters.
+_claim_ticket_stmt = lambda_stmt(
+    lambda: update(QueueTicket)
+    .where(and_(
+        QueueTicket.ticket_id == bindparam('tid'),
+        QueueTicket.queue_status.in_(['WAITING', 'CALLED'])
+    ))
+    .values(queue_status='IN_PROGRESS', started_at=bindparam('now'), updated_at=bindparam('now'))
+    .returning(QueueTicket.ticket_id, QueueTicket.visit_id)
+)
+
+_otp_lookup_stmt = lambda_stmt(
+    lambda: select(OTPVerification)
+    .options(joinedload(OTPVerification.patient).load_only(Patient.patient_id), raiseload('*'))
+    .where(and_(
+        OTPVerification.phone_number == bindparam('phone'),
+        OTPVerification.otp_code == bindparam('code'),
+        OTPVerification.is_verified == False,
+        OTPVerification.is_expired == False,
+        OTPVerification.retry_count < OTPVerification.max_attempts,
+        OTPVerification.expires_at > bindparam('now')
+    ))
+)
+
 
 def start_appointment(
     db: Session,
@@ -16,68 +44,67 @@ def start_appointment(
     """
     try:
         # print(f"Ticket ID: {request.ticket_id}")
-        # Step 1: Find queue ticket
-        ticket = db.query(QueueTicket).filter(
-            QueueTicket.ticket_id == request.ticket_id
-        ).first()
+        now = utc_now()
         
-        if not ticket:
-            # print(f"Ticket #{request.ticket_id} not found")
-            return False, "Queue ticket not found", {}
+        # Step 1: Claim the queue ticket if it is still WAITING/CALLED
+        claimed = db.execute(
+            _claim_ticket_stmt, {"tid": request.ticket_id, "now": now}
+        ).first()
         
-        # print(f"Found ticket #{ticket.ticket_id}")
-        # print(f"   Current status: {ticket.queue_status}")
+        # Step 2: Nothing claimed - report why
+        if not claimed:
+            db.rollback()
+            current = db.query(QueueTicket.queue_status).filter(
+                QueueTicket.ticket_id == request.ticket_id
+            ).first()
+            
+            if not current:
+                # print(f"Ticket #{request.ticket_id} not found")
+                return False, "Queue ticket not found", {}
+            
+            # print(f"Invalid status: {current.queue_status}")
+            return False, f"Cannot start appointment. Current status: {current.queue_status}", {}
         
-        # Step 2: Validate current status
-        if ticket.queue_status not in ['WAITING', 'CALLED']:
-            # print(f"Invalid status: {ticket.queue_status}")
-            return False, f"Cannot start appointment. Current status: {ticket.queue_status}", {}
+        ticket_id, visit_id = claimed
         
-        # Step 3: Get visit details
-        visit = db.query(Visit).filter(
-            Visit.visit_id == ticket.visit_id
+        # Step 3: Update visit status
+        visit = db.execute(
+            update(Visit)
+            .where(Visit.visit_id == visit_id)
+            .values(visit_status='IN_PROGRESS', updated_at=now)
+            .returning(Visit.patient_id)
         ).first()
         
         if not visit:
-            # print(f"Visit #{ticket.visit_id} not found")
+            db.rollback()
+            # print(f"Visit #{visit_id} not found")
             return False, "Visit not found", {}
         
-        # print(f"Found visit #{visit.visit_id}")
-        
-        # Step 4: Get patient details
-        patient = db.query(Patient).filter(
+        # Step 4: Get patient name
+        patient = db.query(Patient.first_name, Patient.last_name).filter(
             Patient.patient_id == visit.patient_id
         ).first()
         
         if not patient:
+            db.rollback()
             # print(f"Patient #{visit.patient_id} not found")
             return False, "Patient not found", {}
         
         patient_name = f"{patient.first_name} {patient.last_name}"
         # print(f"Found patient: {patient_name}")
         
-        # Step 5: Update queue ticket
-        old_status = ticket.queue_status
-        ticket.queue_status = 'IN_PROGRESS'
-        ticket.started_at = datetime.utcnow()
-        ticket.updated_at = datetime.utcnow()
-        
-        # Step 6: Update visit status
-        visit.visit_status = 'IN_PROGRESS'
-        visit.updated_at = datetime.utcnow()
-        
-        # Step 7: Commit changes
+        # Step 5: Commit changes
         db.commit()
         
-        # print(f"Status updated: {old_status} → IN_PROGRESS")
-        # print(f"Started at: {ticket.started_at}")
+        # print(f"Status updated → IN_PROGRESS")
+        # print(f"Started at: {now}")
         
         return True, "Appointment started successfully", {
-            "ticket_id": ticket.ticket_id,
-            "visit_id": visit.visit_id,
+            "ticket_id": ticket_id,
+            "visit_id": visit_id,
             "patient_name": patient_name,
-            "queue_status": ticket.queue_status,
-            "started_at": ticket.started_at
+            "queue_status": 'IN_PROGRESS',
+            "started_at": now
         }
         
     except Exception as e:
@@ -96,127 +123,117 @@ def verify_otp_and_checkin(
     try:
         # print(f"Phone: {request.phone_number}")
         # print(f"Code: {request.otp_code}")
-        
-        # Step 1: Find valid OTP
-        otp_record = db.query(OTPVerification).filter(
-            and_(
-                OTPVerification.phone_number == request.phone_number,
-                OTPVerification.otp_code == request.otp_code,
-                OTPVerification.is_verified == False,
-                OTPVerification.is_expired == False,
-                OTPVerification.expires_at > func.now()
-            )
-        ).first()
+        now = datetime.now(timezone.utc)
+        
+        # Step 1: Find valid OTP together with its patient
+        otp_record = db.execute(
+            _otp_lookup_stmt,
+            {
+                "phone": request.phone_number,
+                "code": request.otp_code,
+                "now": now
+            }
+        ).scalars().first()
         
         if not otp_record:
             return False, "Invalid or expired OTP", {}
         
         print(f"Found valid OTP: {otp_record.otp_id}")
         
-        # Step 2: Check retry attempts
-        if otp_record.retry_count >= otp_record.max_attempts:
-            otp_record.is_expired = True
-            db.commit()
-            return False, "Maximum OTP verification attempts exceeded", {}
-        
-        # Step 3: Verify patient exists
-        patient = db.query(Patient).filter(
-            Patient.patient_id == otp_record.patient_id
-        ).first()
+        # Step 2: Verify patient exists
+        patient = otp_record.patient
         
         if not patient:
             return False, "Patient not found", {}
         
         # print(f"Patient: {patient.first_name} {patient.last_name}")
         
-        # Step 4: Mark OTP as verified
+        # Step 3: Mark OTP as verified
         otp_record.is_verified = True
-        otp_record.verified_at = datetime.utcnow()
-        otp_record.updated_at = datetime.utcnow()
-        
-        # Step 5: Check if patient already checked in today
-        today = datetime.utcnow().date()
-        existing_visit = db.query(Visit).filter(
-            and_(
-                Visit.patient_id == patient.patient_id,
-                Visit.visit_date == today,
-                Visit.visit_status.in_(['ACTIVE', 'WAITING', 'IN_PROGRESS'])
+        otp_record.verified_at = now
+        otp_record.updated_at = now
+        
+        # Step 4: Get department service time for wait time (cached)
+        today = now.date()
+        average_service_time = get_average_service_time(db, request.department_id)
+        
+        # Step 5: Create visit, claim the next queue position and create the
+        # queue ticket in a single statement. If the patient already has an
+        # active visit today the visit insert is skipped and so is the rest.
+        new_visit = active_visit_insert(
+            patient_id=patient.patient_id,
+            department_id=request.department_id,
+            doctor_id=request.doctor_id,
+            visit_date=today,
+            check_in_datetime=now.replace(tzinfo=None),
+            check_in_method=request.check_in_method,
+            visit_status='ACTIVE'
+        ).returning(Visit.visit_id).cte("new_visit")
+        new_position = _claim_queue_position(
+            today, request.department_id, source=new_visit
+        ).cte("new_position")
+        tickets_ahead = _open_tickets_ahead(today, request.department_id)
+        created = db.execute(
+            insert(QueueTicket)
+            .from_select(
+                ['visit_id', 'queue_date', 'queue_status', 'queue_position', 'estimated_wait_time'],
+                select(
+                    new_visit.c.visit_id,
+                    literal(today),
+                    literal('WAITING'),
+                    new_position.c.queue_position,
+                    tickets_ahead * average_service_time
+                ).select_from(
+                    # Both CTEs return at most one row
+                    new_visit.join(new_position, true())
+                )
+            )
+            .returning(
+                QueueTicket.visit_id,
+                QueueTicket.ticket_id,
+                QueueTicket.queue_position,
+                QueueTicket.estimated_wait_time
             )
         ).first()
         
-        if existing_visit:
-            queue_ticket = db.query(QueueTicket).filter(
-                QueueTicket.visit_id == existing_visit.visit_id
+        # Step 6: Patient already checked in today - return the existing ticket
+        if not created:
+            existing_visit = db.query(Visit).options(
+                joinedload(Visit.queue_ticket),
+                raiseload('*')
+            ).filter(
+                and_(
+                    Visit.patient_id == patient.patient_id,
+                    Visit.visit_date == today,
+                    Visit.visit_status.in_(ACTIVE_VISIT_STATUSES)
+                )
             ).first()
+            queue_ticket = existing_visit.queue_ticket if existing_visit else None
             
             db.commit()
             
             return True, "Already checked in for today", {
+                "new_check_in": False,
                 "patient_id": patient.patient_id,
-                "visit_id": existing_visit.visit_id,
+                "visit_id": existing_visit.visit_id if existing_visit else None,
                 "ticket_id": queue_ticket.ticket_id if queue_ticket else None,
                 "queue_position": queue_ticket.queue_position if queue_ticket else None,
                 "estimated_wait_time": queue_ticket.estimated_wait_time if queue_ticket else None
             }
         
-        # Step 6: Create new visit
-        new_visit = Visit(
-            patient_id=patient.patient_id,
-            department_id=request.department_id,
-            doctor_id=request.doctor_id,
-            visit_date=today,
-            check_in_datetime=datetime.utcnow(),
-            check_in_method=request.check_in_method,
-            visit_status='ACTIVE'
-        )
-        db.add(new_visit)
-        db.flush()
-        
-        # print(f"Created visit #{new_visit.visit_id}")
-        
-        # Step 7: Calculate queue position
-        max_position = db.query(func.max(QueueTicket.queue_position)).filter(
-            and_(
-                QueueTicket.queue_date == today,
-                QueueTicket.queue_status.in_(['WAITING', 'CALLED', 'IN_PROGRESS'])
-            )
-        ).scalar() or 0
-        
-        new_position = max_position + 1
-        
-        # Step 8: Get department info for wait time
-        department = db.query(Department).filter(
-            Department.department_id == request.department_id
-        ).first()
-        
-        average_service_time = department.average_service_time if department else 30
-        estimated_wait = (new_position - 1) * average_service_time
-        
-        # print(f"Queue position: {new_position}")
-        # print(f"Estimated wait: {estimated_wait} minutes")
-        
-        # Step 9: Create queue ticket
-        queue_ticket = QueueTicket(
-            visit_id=new_visit.visit_id,
-            queue_date=today,
-            queue_status='WAITING',
-            queue_position=new_position,
-            estimated_wait_time=estimated_wait
-        )
-        db.add(queue_ticket)
-        db.flush()
-        
-        # print(f"Created ticket #{queue_ticket.ticket_id}")
+        # print(f"Created visit #{created.visit_id}, ticket #{created.ticket_id}")
+        # print(f"Queue position: {created.queue_position}")
         
         # Commit all changes
         db.commit()
         
         return True, "Check-in successful", {
+            "new_check_in": True,
             "patient_id": patient.patient_id,
-            "visit_id": new_visit.visit_id,
-            "ticket_id": queue_ticket.ticket_id,
-            "queue_position": new_position,
-            "estimated_wait_time": estimated_wait
+            "visit_id": created.visit_id,
+            "ticket_id": created.ticket_id,
+            "queue_position": created.queue_position,
+            "estimated_wait_time": created.estimated_wait_time
         }
         
     except Exception as e:
@@ -227,9 +244,227 @@ def verify_otp_and_checkin(
         return False, f"Error during check-in: {str(e)}", {}
     
 # Helper functions
+ACTIVE_VISIT_STATUSES = ['ACTIVE', 'WAITING', 'IN_PROGRESS']
+# Queue ticket statuses that still hold a place in the queue
+OPEN_TICKET_STATUSES = [QueueStatus.WAITING.value, QueueStatus.CALLED.value, QueueStatus.IN_PROGRESS.value]
+DEPARTMENT_CACHE_TTL = 300  # seconds
+DEFAULT_SERVICE_TIME = 30  # minutes
+
+# department_id -> (expires_at, average_service_time)
+_department_service_times: Dict[int, Tuple[float, Optional[int]]] = {}
+
+
+def get_average_service_time(db: Session, department_id: Optional[int]) -> int:
+    """
+    Get a department's average service time, cached in-process for
+    DEPARTMENT_CACHE_TTL seconds since departments rarely change
+    """
+    if department_id is None:
+        return DEFAULT_SERVICE_TIME
+    
+    cached = _department_service_times.get(department_id)
+    if cached and cached[0] > time.monotonic():
+        service_time = cached[1]
+    else:
+        service_time = db.query(Department.average_service_time).filter(
+            Department.department_id == department_id
+        ).scalar()
+        _department_service_times[department_id] = (
+            time.monotonic() + DEPARTMENT_CACHE_TTL,
+            service_time
+        )
+    
+    return service_time if service_time is not None else DEFAULT_SERVICE_TIME
+
+
+def invalidate_department_cache(department_id: Optional[int] = None):
+    """Drop cached department data; call after a department is updated"""
+    if department_id is None:
+        _department_service_times.clear()
+    else:
+        _department_service_times.pop(department_id, None)
+
+
+QUEUE_CACHE_TTL = 5  # seconds
+QUEUE_CACHE_MAX_ENTRIES = 256
+
+# (doctor_id, queue_date) -> (expires_at, ClinicianQueueResponse)
+_clinician_queues: Dict[Tuple[int, date], Tuple[float, Any]] = {}
+# Bumped on every invalidation so reads that raced a queue change are not cached
+_queue_cache_generation = 0
+_queue_cache_lock = threading.Lock()
+
+
+def queue_cache_generation() -> int:
+    """Current queue cache generation; read it before loading a queue from the DB"""
+    return _queue_cache_generation
+
+
+def get_cached_clinician_queue(doctor_id: int, queue_date: date):
+    """Return a cached clinician queue snapshot, or None if missing/stale"""
+    cached = _clinician_queues.get((doctor_id, queue_date))
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    return None
+
+
+def cache_clinician_queue(doctor_id: int, queue_date: date, response, generation: int):
+    """
+    Cache a clinician queue snapshot for QUEUE_CACHE_TTL seconds. Skipped if
+    the queue changed since generation was read, as the snapshot may predate it.
+    """
+    now = time.monotonic()
+    with _queue_cache_lock:
+        if generation != _queue_cache_generation:
+            return
+        
+        # Drop expired snapshots, then the oldest ones if still over the cap
+        for key in [k for k, (expires_at, _) in _clinician_queues.items() if expires_at <= now]:
+            del _clinician_queues[key]
+        while len(_clinician_queues) >= QUEUE_CACHE_MAX_ENTRIES:
+            del _clinician_queues[next(iter(_clinician_queues))]
+        
+        _clinician_queues[(doctor_id, queue_date)] = (now + QUEUE_CACHE_TTL, response)
+
+
+def invalidate_queue_cache():
+    """Drop cached queue snapshots; call after any queue ticket change"""
+    global _queue_cache_generation
+    with _queue_cache_lock:
+        _queue_cache_generation += 1
+        _clinician_queues.clear()
+
+
+def active_visit_insert(**values):
+    """
+    INSERT for a visit that is skipped (ON CONFLICT DO NOTHING) when the
+    patient already has an active visit that day
+    """
+    return pg_insert(Visit).values(**values).on_conflict_do_nothing(
+        index_elements=[Visit.patient_id, Visit.visit_date],
+        index_where=Visit.visit_status.in_(ACTIVE_VISIT_STATUSES)
+    )
+
+
+def _claim_queue_position(queue_date: date, department_id: Optional[int] = None, source=None):
+    """
+    INSERT ... ON CONFLICT DO UPDATE on the queue_counters row that hands
+    out the next queue position for a department and day. Each department
+    has its own row so check-ins for different departments never wait on
+    the same row lock. With ``source`` (a CTE) a position is only claimed
+    when that CTE returned a row.
+    """
+    department_key = department_id or 0
+    if source is None:
+        stmt = pg_insert(QueueCounter).values(
+            queue_date=queue_date,
+            department_id=department_key,
+            next_position=2
+        )
+    else:
+        stmt = pg_insert(QueueCounter).from_select(
+            ['queue_date', 'department_id', 'next_position'],
+            select(literal(queue_date), literal(department_key), literal(2)).select_from(source)
+        )
+    return stmt.on_conflict_do_update(
+        index_elements=[QueueCounter.queue_date, QueueCounter.department_id],
+        set_={"next_position": QueueCounter.next_position + 1}
+    ).returning((QueueCounter.next_position - 1).label("queue_position"))
+
+
+def _open_tickets_ahead(queue_date: date, department_id: Optional[int] = None):
+    """
+    Scalar subquery counting the department's tickets still in the queue for
+    the day. Queue positions keep counting up all day, so the wait estimate
+    is based on this instead of the position.
+    """
+    department_filter = (
+        Visit.department_id.is_(None) if department_id is None
+        else Visit.department_id == department_id
+    )
+    return (
+        select(func.count())
+        .select_from(QueueTicket)
+        .join(Visit, Visit.visit_id == QueueTicket.visit_id)
+        .where(and_(
+            QueueTicket.queue_date == queue_date,
+            QueueTicket.queue_status.in_(OPEN_TICKET_STATUSES),
+            department_filter
+        ))
+        .scalar_subquery()
+    )
+
+
+def create_queue_ticket(
+    db: Session,
+    visit_id: int,
+    queue_date: date,
+    department_id: Optional[int] = None
+):
+    """
+    Create a WAITING queue ticket for a visit, claiming its queue position
+    in the same statement. Returns (ticket_id, queue_position).
+    """
+    new_position = _claim_queue_position(queue_date, department_id).cte("new_position")
+    return db.execute(
+        insert(QueueTicket)
+        .from_select(
+            ['visit_id', 'queue_date', 'queue_status', 'queue_position'],
+            select(
+                literal(visit_id),
+                literal(queue_date),
+                literal('WAITING'),
+                new_position.c.queue_position
+            )
+        )
+        .returning(QueueTicket.ticket_id, QueueTicket.queue_position)
+    ).one()
+
+
+def log_check_in(session_factory, visit_id: int, patient_id: int, check_in_method: str):
+    """
+    Record a check-in in check_in_logs. Runs as a background task after
+    the response is sent, so it opens its own session from session_factory.
+    """
+    db = session_factory()
+    try:
+        db.execute(
+            insert(CheckInLog).values(
+                visit_id=visit_id,
+                patient_id=patient_id,
+                check_in_method=check_in_method
+            )
+        )
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"Error logging check-in: {str(e)}")
+    finally:
+        db.close()
+
+
+def create_otp_batch(db: Session, records: List[Dict[str, Any]]) -> List[int]:
+    """
+    Insert OTP records in one round trip and return their IDs in the same
+    order as records. All records should carry the same keys. The caller
+    commits.
+    """
+    return db.execute(
+        insert(OTPVerification).returning(
+            OTPVerification.otp_id, sort_by_parameter_order=True
+        ),
+        records
+    ).scalars().all()
+
+
+def utc_now() -> datetime:
+    """Current UTC time, naive, for the DateTime columns stored without a timezone"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 def generate_otp(length=6):
-    """Generate random OTP"""
-    return ''.join(random.choices(string.digits, k=length))
+    """Generate random OTP using a cryptographically secure source"""
+    return f"{secrets.randbelow(10 ** length):0{length}d}"
 
 
 def send_sms(phone_number: str, message: str):
@@ -1,15 +1,20 @@
 # =============================================
 # FILE: main.py (Updated)
 # =============================================
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from routers import apiRouter
+from config import Config
+from database import request_query_stats
 from fastapi import FastAPI, HTTPException, Depends, Query
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
 import uvicorn
 import os
 import sys
+import logging
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(
     title="Healthcare Queue Management API",
@@ -26,6 +31,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+# Warn when a single request issues too many or too slow SQL queries,
+# which usually means an N+1 pattern crept in
+@app.middleware("http")
+async def log_query_stats(request: Request, call_next):
+    stats = [0, 0.0]
+    token = request_query_stats.set(stats)
+    try:
+        response = await call_next(request)
+    finally:
+        request_query_stats.reset(token)
+    
+    query_count, sql_ms = stats[0], stats[1] * 1000
+    if query_count > Config.SQL_WARN_QUERY_COUNT or sql_ms > Config.SQL_WARN_TIME_MS:
+        logger.warning(
+            "%s %s ran %d SQL queries in %.1f ms",
+            request.method, request.url.path, query_count, sql_ms
+        )
+    return response
+
 # Include routers
 app.include_router(apiRouter.router)
 # Include routers
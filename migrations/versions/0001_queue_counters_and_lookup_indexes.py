@@ -0,0 +1,80 @@
+"""Queue counter table, lookup indexes and the OTP patient foreign key
+
+For databases created before they were added to models.py.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-15
+"""
+from alembic import op
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Per-department, per-day queue position counter
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS queue_counters (
+            queue_date DATE NOT NULL,
+            department_id INTEGER NOT NULL,
+            next_position INTEGER NOT NULL,
+            PRIMARY KEY (queue_date, department_id)
+        )
+    """)
+    
+    # Continue numbering after the tickets already issued for today onwards,
+    # so new check-ins do not reuse a queue position
+    op.execute("""
+        INSERT INTO queue_counters (queue_date, department_id, next_position)
+        SELECT qt.queue_date, COALESCE(v.department_id, 0), COALESCE(MAX(qt.queue_position), 0) + 1
+        FROM queue_tickets qt
+        JOIN visits v ON v.visit_id = qt.visit_id
+        WHERE qt.queue_date >= CURRENT_DATE
+        GROUP BY qt.queue_date, COALESCE(v.department_id, 0)
+        ON CONFLICT (queue_date, department_id) DO NOTHING
+    """)
+    
+    op.execute("""
+        CREATE INDEX IF NOT EXISTS ix_qt_day_status
+            ON queue_tickets (queue_date, queue_status) INCLUDE (queue_position)
+    """)
+    op.execute("""
+        CREATE INDEX IF NOT EXISTS ix_visit_active
+            ON visits (patient_id, visit_date, visit_status)
+    """)
+    op.execute("""
+        CREATE INDEX IF NOT EXISTS ix_otp_lookup
+            ON otp_verifications (phone_number, otp_code, is_verified, is_expired)
+    """)
+    
+    # OTPs pointing at patients that no longer exist would block the foreign key
+    op.execute("""
+        UPDATE otp_verifications o
+        SET patient_id = NULL
+        WHERE o.patient_id IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM patients p WHERE p.patient_id = o.patient_id)
+    """)
+    op.execute("""
+        DO $$
+        BEGIN
+            IF NOT EXISTS (
+                SELECT 1 FROM pg_constraint WHERE conname = 'otp_verifications_patient_id_fkey'
+            ) THEN
+                ALTER TABLE otp_verifications
+                    ADD CONSTRAINT otp_verifications_patient_id_fkey
+                    FOREIGN KEY (patient_id) REFERENCES patients (patient_id);
+            END IF;
+        END
+        $$
+    """)
+
+
+def downgrade():
+    op.execute("ALTER TABLE otp_verifications DROP CONSTRAINT IF EXISTS otp_verifications_patient_id_fkey")
+    op.execute("DROP INDEX IF EXISTS ix_otp_lookup")
+    op.execute("DROP INDEX IF EXISTS ix_visit_active")
+    op.execute("DROP INDEX IF EXISTS ix_qt_day_status")
+    op.execute("DROP TABLE IF EXISTS queue_counters")
@@ -0,0 +1,64 @@
+"""One active visit per patient per day
+
+Check-ins rely on uq_visit_active_day for INSERT ... ON CONFLICT DO
+NOTHING and fail without it.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-15
+"""
+from alembic import op
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Block concurrent check-ins until the index exists, so no new duplicate
+    # slips in between the cleanup and CREATE UNIQUE INDEX
+    op.execute("LOCK TABLE visits IN SHARE ROW EXCLUSIVE MODE")
+    
+    # Earlier QR check-ins opened a new ACTIVE visit on every scan. Keep one
+    # visit per patient and day (the one in progress, else the first) and
+    # cancel the rest together with their open queue tickets.
+    op.execute("""
+        WITH ranked AS (
+            SELECT visit_id,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY patient_id, visit_date
+                       ORDER BY (visit_status = 'IN_PROGRESS') DESC, visit_id
+                   ) AS keep_rank
+            FROM visits
+            WHERE visit_status IN ('ACTIVE', 'WAITING', 'IN_PROGRESS')
+              AND patient_id IS NOT NULL
+        ),
+        cancelled_visits AS (
+            UPDATE visits v
+            SET visit_status = 'CANCELLED',
+                updated_at = now() AT TIME ZONE 'UTC'
+            FROM ranked r
+            WHERE v.visit_id = r.visit_id
+              AND r.keep_rank > 1
+            RETURNING v.visit_id
+        )
+        UPDATE queue_tickets qt
+        SET queue_status = 'CANCELLED',
+            completed_at = now() AT TIME ZONE 'UTC',
+            updated_at = now() AT TIME ZONE 'UTC'
+        FROM cancelled_visits cv
+        WHERE qt.visit_id = cv.visit_id
+          AND qt.queue_status IN ('WAITING', 'CALLED', 'IN_PROGRESS')
+    """)
+    
+    op.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_visit_active_day
+            ON visits (patient_id, visit_date)
+            WHERE visit_status IN ('ACTIVE', 'WAITING', 'IN_PROGRESS')
+    """)
+
+
+def downgrade():
+    # Duplicate visits cancelled by the upgrade are not restored
+    op.execute("DROP INDEX IF EXISTS uq_visit_active_day")
@@ -0,0 +1,48 @@
+"""Trigram indexes for patient search
+
+search_patients ranks matches with similarity(), which comes from
+pg_trgm, so the extension is required.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-15
+"""
+from alembic import op
+from sqlalchemy import text
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+TRIGRAM_COLUMNS = ["first_name", "last_name", "phone_number"]
+
+
+def _is_invalid_index(name):
+    """True if a previous CONCURRENTLY build failed and left the index INVALID"""
+    return bool(op.get_bind().execute(
+        text("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"),
+        {"name": name}
+    ).scalar())
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    
+    # Build outside a transaction with CONCURRENTLY so patients stays
+    # writable while the GIN indexes are built on a live database
+    with op.get_context().autocommit_block():
+        for column in TRIGRAM_COLUMNS:
+            name = f"ix_patient_{column}_trgm"
+            if _is_invalid_index(name):
+                op.execute(f"DROP INDEX CONCURRENTLY {name}")
+            op.execute(f"""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS {name}
+                    ON patients USING gin ({column} gin_trgm_ops) WHERE deleted_at IS NULL
+            """)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for column in TRIGRAM_COLUMNS:
+            op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS ix_patient_{column}_trgm")
@@ -0,0 +1,28 @@
+"""Drop the single-column OTP phone_number index
+
+ix_otp_lookup starts with phone_number and serves the same lookups, so
+the separate index is only extra work on every OTP insert.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-15
+"""
+from alembic import op
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_otp_verifications_phone_number")
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_otp_verifications_phone_number"
+            " ON otp_verifications (phone_number)"
+        )
@@ -1,5 +1,5 @@
-from sqlalchemy import Boolean, Column, Integer, String, Date, Text, DateTime,ForeignKey
-from sqlalchemy.sql import func
+from sqlalchemy import Boolean, Column, Integer, String, Date, Text, DateTime,ForeignKey, Index, DDL, event
+from sqlalchemy.sql import func, text
 from sqlalchemy.orm import relationship
 from database import Base
 from datetime import datetime
@@ -7,6 +7,9 @@ from datetime import datetime
 
 class QueueTicket(Base):
     __tablename__ = "queue_tickets"
+    __table_args__ = (
+        Index('ix_qt_day_status', 'queue_date', 'queue_status', postgresql_include=['queue_position']),
+    )
     
     ticket_id = Column(Integer, primary_key=True, autoincrement=True)
     visit_id = Column(Integer, ForeignKey("visits.visit_id"), unique=True)
@@ -25,8 +28,26 @@ class QueueTicket(Base):
     visit = relationship("Visit", back_populates="queue_ticket")
 
 
+class QueueCounter(Base):
+    __tablename__ = "queue_counters"
+    
+    queue_date = Column(Date, primary_key=True)
+    department_id = Column(Integer, primary_key=True)  # 0 when no department
+    next_position = Column(Integer, nullable=False)
+
+
 class Visit(Base):
     __tablename__ = "visits"
+    __table_args__ = (
+        # Serves visit lookups outside the active statuses (e.g. the 'scheduled'
+        # visit in sms_checkin) and is the only index on the patient_id FK
+        Index('ix_visit_active', 'patient_id', 'visit_date', 'visit_status'),
+        Index(
+            'uq_visit_active_day', 'patient_id', 'visit_date',
+            unique=True,
+            postgresql_where=text("visit_status IN ('ACTIVE', 'WAITING', 'IN_PROGRESS')")
+        ),
+    )
     
     visit_id = Column(Integer, primary_key=True, autoincrement=True)
     patient_id = Column(Integer, ForeignKey("patients.patient_id"))
@@ -50,24 +71,50 @@ class Visit(Base):
 #OTP Verification table
 class OTPVerification(Base):
     __tablename__ = "otp_verifications"
+    __table_args__ = (
+        Index('ix_otp_lookup', 'phone_number', 'otp_code', 'is_verified', 'is_expired'),
+    )
     
     otp_id = Column(Integer, primary_key=True, index=True)
-    phone_number = Column(String(20), nullable=False, index=True)
+    phone_number = Column(String(20), nullable=False)  # leads ix_otp_lookup
     otp_code = Column(String(10), nullable=False)
     is_verified = Column(Boolean, default=False)
     is_expired = Column(Boolean, default=False)
     retry_count = Column(Integer, default=0)
     max_attempts = Column(Integer, default=3)
-    patient_id = Column(Integer, nullable=True)
+    patient_id = Column(Integer, ForeignKey("patients.patient_id"), nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     verified_at = Column(DateTime(timezone=True), nullable=True)
     expires_at = Column(DateTime(timezone=True), nullable=False)
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    
+    patient = relationship("Patient")
 
 
 # Patient table
 class Patient(Base):
     __tablename__ = "patients"
+    # Trigram indexes so the ILIKE '%...%' patient search can use an index
+    __table_args__ = (
+        Index(
+            'ix_patient_first_name_trgm', 'first_name',
+            postgresql_using='gin',
+            postgresql_ops={'first_name': 'gin_trgm_ops'},
+            postgresql_where=text("deleted_at IS NULL")
+        ),
+        Index(
+            'ix_patient_last_name_trgm', 'last_name',
+            postgresql_using='gin',
+            postgresql_ops={'last_name': 'gin_trgm_ops'},
+            postgresql_where=text("deleted_at IS NULL")
+        ),
+        Index(
+            'ix_patient_phone_number_trgm', 'phone_number',
+            postgresql_using='gin',
+            postgresql_ops={'phone_number': 'gin_trgm_ops'},
+            postgresql_where=text("deleted_at IS NULL")
+        ),
+    )
     patient_id = Column(Integer, primary_key=True, index=True)
     first_name = Column(String(100), nullable=False)
     last_name = Column(String(100), nullable=False)
@@ -90,6 +137,15 @@ class Patient(Base):
     
     # ADD THIS LINE:
     visits = relationship("Visit", back_populates="patient")
+
+
+# The trigram indexes on patients need the pg_trgm extension
+event.listen(
+    Patient.__table__,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql")
+)
+
     
 class Department(Base):
     __tablename__ = "departments"
@@ -1,15 +1,14 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session  
-from database import get_db,engine
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request, Response, status
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.orm import Session, contains_eager, joinedload, load_only, sessionmaker
+from database import get_db, get_session_factory
 from schemas import *
 import crud
 from typing import List, Optional, Annotated
-import random
 from fastapi import Query
 import models
-from datetime import datetime, date, timedelta
-
-models.Base.metadata.create_all(bind=engine)
+from datetime import datetime, date, timedelta, timezone
+import hashlib
 
 router = APIRouter(
     prefix="/api",
@@ -17,9 +16,31 @@ router = APIRouter(
 )
 
 db_dependency = Annotated[Session, Depends(get_db)]
+session_factory_dependency = Annotated[sessionmaker, Depends(get_session_factory)]
+
+# Timestamp column set when a ticket moves into each status
+STATUS_TIMESTAMP_COLUMNS = {
+    QueueStatus.CALLED: "called_at",
+    QueueStatus.IN_PROGRESS: "started_at",
+    QueueStatus.COMPLETED: "completed_at",
+    QueueStatus.CANCELLED: "completed_at",
+}
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match check per RFC 9110: "*" or any listed tag, compared weakly"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        tag.strip().removeprefix("W/") == etag
+        for tag in if_none_match.split(",")
+    )
+
 
 @router.post("/appointments/start", response_model=AppointmentStartResponse, status_code=status.HTTP_200_OK)
-async def start_appointment(
+def start_appointment(
     request: AppointmentStartRequest,
     db: db_dependency, # type: ignore
 ):
@@ -36,6 +57,7 @@ async def start_appointment(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=message
         )
+    crud.invalidate_queue_cache()
     
     return AppointmentStartResponse(
         success=success,
@@ -48,21 +70,26 @@ async def start_appointment(
     )
 
 @router.post("/otp/verify", response_model=OTPVerifyResponse, status_code=status.HTTP_200_OK)
-async def verify_otp(
+def verify_otp(
     request: OTPVerifyRequest,
     db: db_dependency, # type: ignore
+    session_factory: session_factory_dependency, # type: ignore
+    background_tasks: BackgroundTasks,
 ):
     """
     Verify OTP and complete patient check-in
     
     - **phone_number**: Patient's registered phone number
-    - **otp_code**: 4-digit OTP code sent to patient
+    - **otp_code**: 6-digit OTP code sent to patient
     - **department_id**: Optional department ID for check-in
     - **doctor_id**: Optional doctor ID for appointment
     - **check_in_method**: Method used for check-in (default: OTP)
     
     Returns:
     - Patient ID, Visit ID, Ticket ID, Queue position, and estimated wait time
+    
+    For a new check-in, the confirmation SMS and check-in log are written
+    after the response is sent.
     """
     success, message, data = crud.verify_otp_and_checkin(db, request)
     
@@ -71,6 +98,20 @@ async def verify_otp(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=message
         )
+    crud.invalidate_queue_cache()
+    
+    # Only a new visit is logged and confirmed; repeat check-ins already were
+    if data.get("new_check_in"):
+        background_tasks.add_task(
+            crud.log_check_in, session_factory, data["visit_id"], data["patient_id"], request.check_in_method
+        )
+        background_tasks.add_task(
+            crud.send_sms,
+            request.phone_number,
+            f"You are checked in. Queue position: {data['queue_position']}, "
+            f"estimated wait: {data['estimated_wait_time']} minutes."
+        )
+    
     return OTPVerifyResponse(
         success=success,
         message=message,
@@ -86,97 +127,119 @@ async def verify_otp(
 def qr_checkin(request: QRCheckInRequest, db: db_dependency,): # type: ignore
     """QR Code Check-in endpoint"""
     
-    # Check if patient exists
-    patient = db.query(models.Patient).filter(
+    # Check if patient exists (only the ID is needed)
+    patient_id = db.query(models.Patient.patient_id).filter(
         models.Patient.phone_number == request.phone_number,
         models.Patient.is_active == True
-    ).first()
+    ).scalar()
     
     # If new patient, create record
-    if not patient:
+    if patient_id is None:
         if not request.first_name or not request.last_name or not request.date_of_birth:
             raise HTTPException(
                 status_code=400,
                 detail="For new patients: first_name, last_name, and date_of_birth are required"
             )
         
-        patient = models.Patient(
-            first_name=request.first_name,
-            last_name=request.last_name,
-            phone_number=request.phone_number,
-            date_of_birth=request.date_of_birth
+        patient_id = db.execute(
+            insert(models.Patient).values(
+                first_name=request.first_name,
+                last_name=request.last_name,
+                phone_number=request.phone_number,
+                date_of_birth=request.date_of_birth
+            ).returning(models.Patient.patient_id)
+        ).scalar_one()
+    
+    # Create visit (skipped if the patient already has an active visit today)
+    now = crud.utc_now()
+    today = now.date()
+    visit_id = db.execute(
+        crud.active_visit_insert(
+            patient_id=patient_id,
+            visit_date=today,
+            check_in_datetime=now,
+            check_in_method="QR_CODE",
+            visit_status="ACTIVE"
+        ).returning(models.Visit.visit_id)
+    ).scalar()
+    
+    if visit_id is None:
+        queue_ticket = db.query(models.QueueTicket).join(models.Visit).filter(
+            models.Visit.patient_id == patient_id,
+            models.Visit.visit_date == today,
+            models.Visit.visit_status.in_(crud.ACTIVE_VISIT_STATUSES)
+        ).first()
+        db.commit()
+        
+        if not queue_ticket:
+            raise HTTPException(
+                status_code=409,
+                detail="Patient already has an active visit today"
+            )
+        
+        return QRCheckInResponse(
+            success=True,
+            message="Already checked in for today",
+            patient_id=patient_id,
+            visit_id=queue_ticket.visit_id,
+            ticket_id=queue_ticket.ticket_id,
+            queue_position=queue_ticket.queue_position
         )
-        db.add(patient)
-        db.flush()
-    
-    # Create visit
-    visit = models.Visit(
-        patient_id=patient.patient_id,
-        visit_date=date.today(),
-        check_in_datetime=datetime.utcnow(),
-        check_in_method="QR_CODE",
-        visit_status="ACTIVE"
-    )
-    db.add(visit)
-    db.flush()
-    
-    # Calculate queue position
-    today = date.today()
-    max_position = db.query(models.QueueTicket).filter(models.QueueTicket.queue_date == today).count()
-    queue_position = max_position + 1
     
-    # Create queue ticket
-    queue_ticket = models.QueueTicket(
-        visit_id=visit.visit_id,
-        queue_date=today,
-        queue_status="WAITING",
-        queue_position=queue_position
-    )
-    db.add(queue_ticket)
+    # Create queue ticket, claiming the next queue position atomically
+    ticket_id, queue_position = crud.create_queue_ticket(db, visit_id, today)
     db.commit()
+    crud.invalidate_queue_cache()
     
     return QRCheckInResponse(
         success=True,
         message="Check-in successful",
-        patient_id=patient.patient_id,
-        visit_id=visit.visit_id,
-        ticket_id=queue_ticket.ticket_id,
+        patient_id=patient_id,
+        visit_id=visit_id,
+        ticket_id=ticket_id,
         queue_position=queue_position
     )
 
 @router.patch("/appointment/{ticket_id}/status")
 def update_appointment_status(ticket_id: int, request: StatusUpdate, db: db_dependency ):# type: ignore
-    """Update appointment/queue ticket status"""
-    
-    # Valid statuses
-    valid_statuses = ["WAITING", "CALLED", "IN_PROGRESS", "COMPLETED", "CANCELLED"]
-    if request.status not in valid_statuses:
-        raise HTTPException(status_code=400, detail=f"Invalid status. Must be one of: {valid_statuses}")
-    
-    # Find ticket
-    ticket = db.query(models.QueueTicket).filter(models.QueueTicket.ticket_id == ticket_id).first()
-    if not ticket:
+    """Update appointment/queue ticket status (validated against QueueStatus)"""
+    
+    # Update status with timestamps in one statement. The row is locked in
+    # the FROM subquery first, so the old status returned is the version
+    # this update actually replaced, even if another update committed first.
+    new_status = request.status.value
+    values = {"queue_status": new_status}
+    
+    timestamp_column = STATUS_TIMESTAMP_COLUMNS.get(request.status)
+    if timestamp_column:
+        values[timestamp_column] = crud.utc_now()
+    
+    previous = (
+        select(models.QueueTicket.ticket_id, models.QueueTicket.queue_status)
+        .where(models.QueueTicket.ticket_id == ticket_id)
+        .with_for_update()
+        .subquery("previous")
+    )
+    old_status = db.execute(
+        update(models.QueueTicket)
+        .where(models.QueueTicket.ticket_id == previous.c.ticket_id)
+        .values(**values)
+        .returning(previous.c.queue_status),
+        execution_options={"synchronize_session": False}
+    ).first()
+    if not old_status:
         raise HTTPException(status_code=404, detail="Ticket not found")
-    
-    # Update status with timestamps
-    old_status = ticket.queue_status
-    ticket.queue_status = request.status
-    
-    if request.status == "CALLED":
-        ticket.called_at = datetime.utcnow()
-    elif request.status == "IN_PROGRESS":
-        ticket.started_at = datetime.utcnow()
-    elif request.status in ["COMPLETED", "CANCELLED"]:
-        ticket.completed_at = datetime.utcnow()
+    old_status = old_status[0]
     
     db.commit()
+    crud.invalidate_queue_cache()
     
     return {
         "success": True,
-        "message": f"Status updated to {request.status}",
+        "message": f"Status updated to {new_status}",
         "ticket_id": ticket_id,
         "old_status": old_status,
-        "new_status": request.status
+        "new_status": new_status
     }
 
 
@@ -198,8 +261,20 @@ def search_patients(
     Returns a list of matching patients.
     """
     
-    # Start with base query, excluding soft-deleted records
-    query = db.query(models.Patient).filter(models.Patient.deleted_at.is_(None))
+    # Reject filter-less searches before touching the database
+    if not any([patient_id is not None, first_name, last_name, phone_number, blood_group, patient_type, is_active is not None]):
+        raise HTTPException(
+            status_code=400,
+            detail="At least one search parameter must be provided"
+        )
+    
+    # Start with a Core select of just the PatientSearchResponse columns,
+    # excluding soft-deleted records. Rows come back as plain mappings
+    # without ORM object hydration.
+    patient_columns = models.Patient.__table__.c
+    query = select(
+        *(patient_columns[name] for name in PatientSearchResponse.model_fields)
+    ).filter(models.Patient.deleted_at.is_(None))
     
     # Apply filters based on provided parameters
     if patient_id is not None:
@@ -223,27 +298,45 @@ def search_patients(
     if is_active is not None:
         query = query.filter(models.Patient.is_active == is_active)
     
-    # Execute query with limit
-    patients = query.limit(limit).all()
+    # Rank substring matches by trigram similarity so the best hits survive the limit
+    similarity_terms = [
+        func.similarity(column, term)
+        for column, term in [
+            (models.Patient.first_name, first_name),
+            (models.Patient.last_name, last_name),
+            (models.Patient.phone_number, phone_number),
+        ]
+        if term
+    ]
+    if similarity_terms:
+        query = query.order_by(sum(similarity_terms[1:], similarity_terms[0]).desc())
     
-    # If no filters provided, return empty list or raise error
-    if all(param is None for param in [patient_id, first_name, last_name, phone_number, blood_group, patient_type, is_active]):
-        raise HTTPException(
-            status_code=400,
-            detail="At least one search parameter must be provided"
-        )
+    # Execute query with limit
+    patients = db.execute(query.limit(limit)).mappings().all()
     
     return patients
  
  
 @router.post("/otp/send", response_model=OTPSendResponse)
-def send_otp(request: OTPSendRequest, db: db_dependency): # type: ignore
-    # Check for existing active OTP
-    existing_otp = db.query(models.OTPVerification).filter(
+def send_otp(request: OTPSendRequest, background_tasks: BackgroundTasks, db: db_dependency): # type: ignore
+    now = datetime.now(timezone.utc)
+    
+    # Check for the newest unexpired OTP, loading only the columns used below.
+    # An exhausted OTP blocks new sends only until it expires.
+    existing_otp = db.query(models.OTPVerification).options(
+        load_only(
+            models.OTPVerification.otp_id,
+            models.OTPVerification.otp_code,
+            models.OTPVerification.retry_count,
+            models.OTPVerification.max_attempts,
+            models.OTPVerification.expires_at
+        )
+    ).filter(
         models.OTPVerification.phone_number == request.phone_number,
         models.OTPVerification.is_expired == False,
-        models.OTPVerification.is_verified == False
-    ).first()
+        models.OTPVerification.is_verified == False,
+        models.OTPVerification.expires_at > now
+    ).order_by(models.OTPVerification.otp_id.desc()).first()
     
     # If exists and not expired, check retry count
     if existing_otp:
@@ -255,9 +348,8 @@ def send_otp(request: OTPSendRequest, db: db_dependency): # type: ignore
         
         # Increment retry count
         existing_otp.retry_count += 1
-        existing_otp.updated_at = datetime.now()
+        existing_otp.updated_at = now
         db.commit()
-        db.refresh(existing_otp)
         
         return OTPSendResponse(
             message="OTP resent successfully",
@@ -266,40 +358,39 @@ def send_otp(request: OTPSendRequest, db: db_dependency): # type: ignore
             expires_at=existing_otp.expires_at.isoformat()
         )
     
-    # Generate 4-digit OTP
-    otp_code = str(random.randint(1000, 9999))
+    # Generate 6-digit OTP (the length /otp/verify accepts)
+    otp_code = crud.generate_otp()
     # Set expiration (5 minutes from now)
-    expires_at = datetime.now() + timedelta(minutes=5)
-    
-    # Create new OTP record
-    new_otp = models.OTPVerification(
-        phone_number=request.phone_number,
-        otp_code=otp_code,
-        is_verified=False,
-        is_expired=False,
-        created_at=datetime.now(),
-        expires_at=expires_at,
-        retry_count=0,
-        max_attempts=3,
-        updated_at=datetime.now()
-    )
-    
-    db.add(new_otp)
+    expires_at = now + timedelta(minutes=5)
+    
+    # Create new OTP record, returning the generated ID in the same statement
+    otp_id, = crud.create_otp_batch(db, [{
+        "phone_number": request.phone_number,
+        "otp_code": otp_code,
+        "is_verified": False,
+        "is_expired": False,
+        "created_at": now,
+        "expires_at": expires_at,
+        "retry_count": 0,
+        "max_attempts": 3,
+        "updated_at": now
+    }])
     db.commit()
-    db.refresh(new_otp)
     
-    # TODO: Send OTP via SMS service (Twilio, etc.)
-    print(f"OTP for {request.phone_number}: {otp_code}")
+    # Send OTP via SMS after the response so the request does not wait on the provider
+    background_tasks.add_task(
+        crud.send_sms, request.phone_number, f"Your OTP is: {otp_code}. Valid for 5 minutes."
+    )
     
     return OTPSendResponse(
         message="OTP sent successfully",
-        otp_id=new_otp.otp_id,
-        otp_code=new_otp.otp_code,
-        expires_at=new_otp.expires_at.isoformat()
+        otp_id=otp_id,
+        otp_code=otp_code,
+        expires_at=expires_at.isoformat()
     )
     
 @router.post("/checkin/sms", response_model=SMSCheckinResponse)
-async def sms_checkin(request: SMSCheckinRequest, db: db_dependency): # type: ignore
+def sms_checkin(request: SMSCheckinRequest, background_tasks: BackgroundTasks, db: db_dependency): # type: ignore
     """
     Handle SMS check-in when patient texts 'JOIN'
     
@@ -331,7 +422,7 @@ async def sms_checkin(request: SMSCheckinRequest, db: db_dependency): # type: ig
         )
     
     # Step 2: Check for today's appointment
-    today = date.today()
+    today = crud.utc_now().date()
     visit = db.query(models.Visit).filter(
         models.Visit.patient_id == patient.patient_id,
         models.Visit.visit_date == today,
@@ -353,22 +444,21 @@ async def sms_checkin(request: SMSCheckinRequest, db: db_dependency): # type: ig
     
     # Step 4: Generate and send OTP
     otp_code = crud.generate_otp()
-    expires_at = datetime.now() + timedelta(minutes=10)
+    expires_at = datetime.now(timezone.utc) + timedelta(minutes=10)
     
     # Save OTP to database
-    otp_record = models.OTPVerification(
-        phone_number=request.phone_number,
-        otp_code=otp_code,
-        patient_id=patient.patient_id,
-        expires_at=expires_at,
-        is_verified=False
-    )
-    db.add(otp_record)
+    crud.create_otp_batch(db, [{
+        "phone_number": request.phone_number,
+        "otp_code": otp_code,
+        "patient_id": patient.patient_id,
+        "expires_at": expires_at,
+        "is_verified": False
+    }])
     db.commit()
     
-    # Send OTP via SMS
+    # Send OTP via SMS once the response is out; the record is already committed
     sms_message = f"Your check-in OTP is: {otp_code}. Valid for 10 minutes."
-    crud.send_sms(request.phone_number, sms_message)
+    background_tasks.add_task(crud.send_sms, request.phone_number, sms_message)
     
     return SMSCheckinResponse(
         success=True,
@@ -378,7 +468,7 @@ async def sms_checkin(request: SMSCheckinRequest, db: db_dependency): # type: ig
     )
 
 @router.get("/queue/clinician/{clinician_id}", response_model=ClinicianQueueResponse)
-async def get_clinician_queue(
+def get_clinician_queue(
     clinician_id: int, db: db_dependency, queue_date: Optional[str] = Query(None, description="Date in YYYY-MM-DD format")): # type: ignore
     """
     Get the queue for a specific clinician/doctor
@@ -386,24 +476,7 @@ async def get_clinician_queue(
     Returns all patients waiting in the doctor's queue with their positions
     """
     
-    # Step 1: Get doctor info
-    doctor = db.query(models.Doctor).filter(
-        models.Doctor.doctor_id == clinician_id,
-        models.Doctor.is_active == True
-    ).first()
-    
-    if not doctor:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Doctor not found"
-        )
-    
-    # Step 2: Get department info
-    department = db.query(models.Department).filter(
-        models.Department.department_id == doctor.department_id
-    ).first()
-    
-    # Step 3: Parse date or use today
+    # Step 1: Parse date or use today
     if queue_date:
         try:
             target_date = date.fromisoformat(queue_date)
@@ -413,23 +486,49 @@ async def get_clinician_queue(
                 detail="Invalid date format. Use YYYY-MM-DD"
             )
     else:
-        target_date = date.today()
+        target_date = crud.utc_now().date()
+    
+    # Step 2: Serve a recent snapshot if the queue has not changed since
+    cache_generation = crud.queue_cache_generation()
+    cached = crud.get_cached_clinician_queue(clinician_id, target_date)
+    if cached is not None:
+        return cached
+    
+    # Step 3: Get doctor info together with the department
+    doctor = db.query(models.Doctor).options(
+        joinedload(models.Doctor.department)
+    ).filter(
+        models.Doctor.doctor_id == clinician_id,
+        models.Doctor.is_active == True
+    ).first()
     
-    # Step 4: Get all queue tickets for this doctor today
-    queue_tickets = db.query(models.QueueTicket).join(models.Visit).filter(
+    if not doctor:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Doctor not found"
+        )
+    
+    # Step 4: Get department info (already loaded with the doctor)
+    department = doctor.department
+    
+    # Step 5: Get all queue tickets for this doctor today, with visit and patient
+    queue_tickets = db.query(models.QueueTicket).join(
+        models.QueueTicket.visit
+    ).join(
+        models.Visit.patient
+    ).options(
+        contains_eager(models.QueueTicket.visit).contains_eager(models.Visit.patient)
+    ).filter(
         models.Visit.doctor_id == clinician_id,
         models.QueueTicket.queue_date == target_date,
-        models.QueueTicket.queue_status.in_(["waiting", "called", "in_progress"])
+        models.QueueTicket.queue_status.in_(crud.OPEN_TICKET_STATUSES)
     ).order_by(models.QueueTicket.queue_position).all()
     
-    # Step 5: Build response with patient details
+    # Step 6: Build response with patient details
     patients_list = []
     for ticket in queue_tickets:
-        # Get visit and patient info
-        visit = db.query(models.Visit).filter(models.Visit.visit_id == ticket.visit_id).first()
-        patient = db.query(models.Patient).filter(
-            models.Patient.patient_id == visit.patient_id
-        ).first()
+        visit = ticket.visit
+        patient = visit.patient
         
         patients_list.append(QueuePatient(
             ticket_id=ticket.ticket_id,
@@ -440,28 +539,41 @@ async def get_clinician_queue(
             check_in_time=visit.check_in_datetime.isoformat() if visit.check_in_datetime else ""
         ))
     
-    return ClinicianQueueResponse(
+    response = ClinicianQueueResponse(
         doctor_id=doctor.doctor_id,
         doctor_name=f"Dr. {doctor.first_name} {doctor.last_name}",
         department_name=department.department_name if department else "Unknown",
         total_patients=len(patients_list),
         queue_tickets=patients_list
     )
+    crud.cache_clinician_queue(clinician_id, target_date, response, cache_generation)
+    
+    return response
 
 
 @router.get("/appointment/status/{appointment_id}", response_model=AppointmentStatusResponse)
-async def get_appointment_status(
+def get_appointment_status(
     appointment_id: int,
+    request: Request,
+    response: Response,
     db: db_dependency # type: ignore
 ):
     """
     Get the current status of an appointment (visit)
     
-    Returns complete appointment info including queue status if checked in
+    Returns complete appointment info including queue status if checked in.
+    Responses carry an ETag; polling clients that send it back in
+    If-None-Match get a 304 until the visit or its queue ticket changes.
     """
     
-    # Step 1: Get the visit/appointment
-    visit = db.query(models.Visit).filter(
+    # Step 1: Get the visit/appointment with patient, doctor, department
+    # and queue ticket in one query
+    visit = db.query(models.Visit).options(
+        joinedload(models.Visit.patient),
+        joinedload(models.Visit.doctor),
+        joinedload(models.Visit.department),
+        joinedload(models.Visit.queue_ticket)
+    ).filter(
         models.Visit.visit_id == appointment_id
     ).first()
     
@@ -471,10 +583,8 @@ async def get_appointment_status(
             detail="Appointment not found"
         )
     
-    # Step 2: Get patient details
-    patient = db.query(models.Patient).filter(
-        models.Patient.patient_id == visit.patient_id
-    ).first()
+    # Step 2: Check patient details
+    patient = visit.patient
     
     if not patient:
         raise HTTPException(
@@ -482,10 +592,8 @@ async def get_appointment_status(
             detail="Patient not found"
         )
     
-    # Step 3: Get doctor details
-    doctor = db.query(models.Doctor).filter(
-        models.Doctor.doctor_id == visit.doctor_id
-    ).first()
+    # Step 3: Check doctor details
+    doctor = visit.doctor
     
     if not doctor:
         raise HTTPException(
@@ -493,17 +601,20 @@ async def get_appointment_status(
             detail="Doctor not found"
         )
     
-    # Step 4: Get department details
-    department = db.query(models.Department).filter(
-        models.Department.department_id == visit.department_id
-    ).first()
+    # Step 4 & 5: Department and queue ticket (may be missing)
+    department = visit.department
+    queue_ticket = visit.queue_ticket
     
-    # Step 5: Get queue ticket if exists
-    queue_ticket = db.query(models.QueueTicket).filter(
-        models.QueueTicket.visit_id == visit.visit_id
-    ).first()
+    # Step 6: Skip the body if the client already has this version
+    etag = '"%s"' % hashlib.md5(
+        f"{visit.visit_id}:{visit.updated_at}:{queue_ticket.updated_at if queue_ticket else ''}".encode(),
+        usedforsecurity=False
+    ).hexdigest()
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    response.headers["ETag"] = etag
     
-    # Step 6: Build response
+    # Step 7: Build response
     return AppointmentStatusResponse(
         visit_id=visit.visit_id,
         patient_name=f"{patient.first_name} {patient.last_name}",
@@ -522,31 +633,37 @@ async def get_appointment_status(
 @router.post("/appointment/complete", response_model=CompleteAppointmentResponse)
 def complete_appointment(request: CompleteAppointmentRequest, db: Session = Depends(get_db)):
     """Complete an appointment"""
-    queue_ticket = db.query(models.QueueTicket).filter(
-        models.QueueTicket.ticket_id == request.ticket_id
+    now = crud.utc_now()
+    
+    # Complete the ticket and the visit it belongs to, committed together
+    queue_ticket = db.execute(
+        update(models.QueueTicket)
+        .where(models.QueueTicket.ticket_id == request.ticket_id)
+        .values(queue_status="COMPLETED", completed_at=now, updated_at=now)
+        .returning(models.QueueTicket.ticket_id, models.QueueTicket.visit_id)
     ).first()
     
     if not queue_ticket:
         raise HTTPException(status_code=404, detail="Ticket not found")
     
-    queue_ticket.queue_status = "COMPLETED"
-    queue_ticket.completed_at = datetime.utcnow()
-    queue_ticket.updated_at = datetime.utcnow()
+    visit_id = db.execute(
+        update(models.Visit)
+        .where(models.Visit.visit_id == queue_ticket.visit_id)
+        .values(visit_status="COMPLETED", completed_datetime=now, updated_at=now)
+        .returning(models.Visit.visit_id)
+    ).scalar_one_or_none()
     
-    visit = db.query(models.Visit).filter(models.Visit.visit_id == queue_ticket.visit_id).first()
-    if not visit:
+    if visit_id is None:
+        db.rollback()
         raise HTTPException(status_code=404, detail="Visit not found")
     
-    visit.visit_status = "COMPLETED"
-    visit.completed_datetime = datetime.utcnow()
-    visit.updated_at = datetime.utcnow()
-    
     db.commit()
+    crud.invalidate_queue_cache()
     
     return CompleteAppointmentResponse(
         success=True,
         message="Appointment completed successfully",
         ticket_id=queue_ticket.ticket_id,
-        visit_id=visit.visit_id,
-        completed_at=queue_ticket.completed_at
+        visit_id=visit_id,
+        completed_at=now
     )
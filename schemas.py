@@ -1,20 +1,22 @@
-from pydantic import BaseModel, Field, validator
-from typing import Optional,List
+from pydantic import BaseModel, ConfigDict, Field, StringConstraints
+from typing import Optional,List, Annotated
 from datetime import datetime, date
+from enum import Enum
 
 
 class AppointmentStartRequest(BaseModel):
     """Request schema for starting an appointment"""
-    ticket_id: int = Field(..., description="Queue ticket ID", example=3)
+    ticket_id: int = Field(..., description="Queue ticket ID", examples=[3])
     doctor_id: Optional[int] = Field(None, description="Doctor ID")
     
-    class Config:
-        json_schema_extra = {
+    model_config = ConfigDict(
+        json_schema_extra={
             "example": {
                 "ticket_id": 3,
                 "doctor_id": 5
             }
         }
+    )
 
 class AppointmentStartResponse(BaseModel):
     """Response schema for appointment start"""
@@ -26,32 +28,23 @@ class AppointmentStartResponse(BaseModel):
     queue_status: str
     started_at: str
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
+
+# Constrained strings, validated by the Pydantic core without Python validators
+PhoneNumber = Annotated[str, StringConstraints(min_length=10, pattern=r"^\+?[\d\-]+$")]
+OTPCode = Annotated[str, StringConstraints(pattern=r"^\d{6}$")]
 
 # OTP Verify Schemas
 class OTPVerifyRequest(BaseModel):
     """Request schema for OTP verification"""
-    phone_number: str = Field(..., description="Patient's phone number", example="+1-555-1011")
-    otp_code: str = Field(..., description="6-digit OTP code", example="123456")
+    phone_number: PhoneNumber = Field(..., description="Patient's phone number", examples=["+1-555-1011"])
+    otp_code: OTPCode = Field(..., description="6-digit OTP code", examples=["123456"])
     department_id: Optional[int] = Field(None, description="Department ID")
     doctor_id: Optional[int] = Field(None, description="Doctor ID")
     check_in_method: str = Field(default="OTP", description="Check-in method")
     
-    @validator('otp_code')
-    def validate_otp_code(cls, v):
-        if not v.isdigit() or len(v) != 6:
-            raise ValueError('OTP code must be 6 digits')
-        return v
-    
-    @validator('phone_number')
-    def validate_phone_number(cls, v):
-        if not v or len(v) < 10:
-            raise ValueError('Invalid phone number')
-        return v
-    
-    class Config:
-        json_schema_extra = {
+    model_config = ConfigDict(
+        json_schema_extra={
             "example": {
                 "phone_number": "+1-555-1011",
                 "otp_code": "123456",
@@ -60,6 +53,7 @@ class OTPVerifyRequest(BaseModel):
                 "check_in_method": "OTP"
             }
         }
+    )
 
 class OTPVerifyResponse(BaseModel):
     """Response schema for OTP verification"""
@@ -71,9 +65,9 @@ class OTPVerifyResponse(BaseModel):
     queue_position: Optional[int] = None
     estimated_wait_time: Optional[int] = None
     
-    class Config:
-        from_attributes = True
-        json_schema_extra = {
+    model_config = ConfigDict(
+        from_attributes=True,
+        json_schema_extra={
             "example": {
                 "success": True,
                 "message": "Check-in successful",
@@ -84,19 +78,20 @@ class OTPVerifyResponse(BaseModel):
                 "estimated_wait_time": 30
             }
         }
+    )
         
 # Request/Response Models
 class QRCheckInRequest(BaseModel):
-    phone_number: str
+    phone_number: PhoneNumber
     qr_code_value: str
     first_name: str = None
     last_name: str = None
     date_of_birth: date = None
     
     
-    class Config:
-        from_attributes = True
-        json_schema_extra = {
+    model_config = ConfigDict(
+        from_attributes=True,
+        json_schema_extra={
             "example": {
                 "phone_number": "1234567890",
                 "qr_code_value": "345678",
@@ -105,6 +100,7 @@ class QRCheckInRequest(BaseModel):
                 "date_of_birth": "2025-11-12"
                 }
             }
+    )
         
 
 class QRCheckInResponse(BaseModel):
@@ -115,8 +111,15 @@ class QRCheckInResponse(BaseModel):
     ticket_id: int
     queue_position: int
 
+class QueueStatus(str, Enum):
+    WAITING = "WAITING"
+    CALLED = "CALLED"
+    IN_PROGRESS = "IN_PROGRESS"
+    COMPLETED = "COMPLETED"
+    CANCELLED = "CANCELLED"
+
 class StatusUpdate(BaseModel):
-    status: str
+    status: QueueStatus
     
 # Patient search response model
 class PatientSearchResponse(BaseModel):
@@ -137,12 +140,11 @@ class PatientSearchResponse(BaseModel):
     emergency_contact_number: Optional[str]
     created_at: datetime
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
         
 # Request model
 class OTPSendRequest(BaseModel):
-    phone_number: str
+    phone_number: PhoneNumber
  
 # Response model
 class OTPSendResponse(BaseModel):
@@ -154,7 +156,7 @@ class OTPSendResponse(BaseModel):
 
 # Request/Response Models
 class SMSCheckinRequest(BaseModel):
-    phone_number: str
+    phone_number: PhoneNumber
     message_body: str
 
 
@@ -174,8 +176,7 @@ class QueuePatient(BaseModel):
     estimated_wait_time: int
     check_in_time: str
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class ClinicianQueueResponse(BaseModel):
@@ -199,8 +200,7 @@ class AppointmentStatusResponse(BaseModel):
     estimated_wait_time: Optional[int] = None
     called_at: Optional[str] = None
     
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
         
 class CompleteAppointmentRequest(BaseModel):
     ticket_id: int
@@ -0,0 +1,34 @@
+"""
+Create all tables for a fresh development database.
+
+Run from the project root:
+    python -m scripts.init_db
+
+Databases that already have tables are upgraded with `alembic upgrade head`
+instead; create_all() never alters existing tables or adds their indexes.
+"""
+import os
+
+from alembic import command
+from alembic.config import Config as AlembicConfig
+from sqlalchemy import inspect
+
+import models
+from database import engine
+
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "alembic.ini")
+
+
+def init_db():
+    if inspect(engine).has_table(models.Patient.__tablename__):
+        print("Database already has tables; run alembic upgrade head instead")
+        return
+    
+    models.Base.metadata.create_all(bind=engine)
+    # The models already include every migration
+    command.stamp(AlembicConfig(ALEMBIC_INI), "head")
+    print("Database tables created")
+
+
+if __name__ == "__main__":
+    init_db()
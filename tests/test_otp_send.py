@@ -0,0 +1,31 @@
+from datetime import datetime, timedelta, timezone
+
+import models
+
+PHONE = "+1-555-1011"
+
+
+def test_send_otp_after_exhausted_otp_expires(client, db_session):
+    # Step 1: First send issues a new OTP
+    response = client.post("/api/otp/send", json={"phone_number": PHONE})
+    assert response.status_code == 200
+    first_otp_id = response.json()["otp_id"]
+    
+    # Step 2: Resend until the attempts are used up, then get rate limited
+    for _ in range(3):
+        response = client.post("/api/otp/send", json={"phone_number": PHONE})
+        assert response.status_code == 200
+        assert response.json()["otp_id"] == first_otp_id
+    
+    response = client.post("/api/otp/send", json={"phone_number": PHONE})
+    assert response.status_code == 429
+    
+    # Step 3: Once the exhausted OTP expires, a fresh one is issued
+    otp = db_session.get(models.OTPVerification, first_otp_id)
+    otp.expires_at = datetime.now(timezone.utc) - timedelta(minutes=1)
+    db_session.commit()
+    
+    response = client.post("/api/otp/send", json={"phone_number": PHONE})
+    assert response.status_code == 200
+    assert response.json()["message"] == "OTP sent successfully"
+    assert response.json()["otp_id"] != first_otp_id